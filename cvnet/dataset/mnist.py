@@ -9,6 +9,7 @@ import os
 
 import torchvision
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from torchvision import transforms
 from torchvision.datasets import MNIST
 
@@ -39,7 +40,7 @@ def load_data_mnist(cfg, is_train=True, root=os.path.join(
 
 
 def load_data_mnist_without_cfg(batch_size, resize=None, root=os.path.join(
-    '~', '.pytorch', 'datasets', 'mnist'), use_normalize=True):
+    '~', '.pytorch', 'datasets', 'mnist'), use_normalize=True, pin_memory=False, distributed=False):
     """Download the MNIST dataset and then load into memory."""
     root = os.path.expanduser(root)
     transformer = []
@@ -54,6 +55,9 @@ def load_data_mnist_without_cfg(batch_size, resize=None, root=os.path.join(
     mnist_test = torchvision.datasets.MNIST(root=root, train=False, transform=transformer, download=False)
     num_workers = 4
 
-    train_iter = DataLoader(mnist_train, batch_size, shuffle=True, num_workers=num_workers)
-    test_iter = DataLoader(mnist_test, batch_size, shuffle=False, num_workers=num_workers)
+    # shard the train set across processes, call train_iter.sampler.set_epoch(epoch) to reshuffle
+    train_sampler = DistributedSampler(mnist_train) if distributed else None
+    train_iter = DataLoader(mnist_train, batch_size, shuffle=train_sampler is None, sampler=train_sampler,
+                            num_workers=num_workers, pin_memory=pin_memory)
+    test_iter = DataLoader(mnist_test, batch_size, shuffle=False, num_workers=num_workers, pin_memory=pin_memory)
     return train_iter, test_iter
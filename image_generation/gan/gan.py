@@ -8,58 +8,47 @@ reference: https://github.com/yunjey/pytorch-tutorial/blob/master/tutorials/03-a
 
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel as DDP
 from torchvision.utils import save_image
 
 sys.path.append("../..")
 from cvnet.dataset import mnist
 
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-print('device:', device)
-
 latent_size = 64
 hidden_size = 128
 image_size = 28 * 28
 num_epochs = 100
-batch_size = 100
+batch_size = 100  # per process
 lr = 0.0002
 sample_dir = "samples"
 
-# Create a directory if not exists
-if not os.path.exists(sample_dir):
-    os.makedirs(sample_dir)
-
-data_loader, _ = mnist.load_data_mnist_without_cfg(batch_size=batch_size, use_normalize=False)
-
-# Discriminator
-D = nn.Sequential(
-    nn.Linear(image_size, hidden_size),
-    nn.LeakyReLU(0.2),
-    nn.Linear(hidden_size, hidden_size),
-    nn.LeakyReLU(0.2),
-    nn.Linear(hidden_size, 1),
-    nn.Sigmoid()
-)
-
-# Generator
-G = nn.Sequential(
-    nn.Linear(latent_size, hidden_size),
-    nn.ReLU(),
-    nn.Linear(hidden_size, hidden_size),
-    nn.ReLU(),
-    nn.Linear(hidden_size, image_size),
-    nn.Tanh()
-)
-
-D = D.to(device)
-G = G.to(device)
-
-# Binary cross entropy loss and optimizer
-loss_fn = nn.BCELoss()
-d_optimizer = torch.optim.Adam(D.parameters(), lr=lr)
-g_optimizer = torch.optim.Adam(G.parameters(), lr=lr)
+
+def build_discriminator():
+    # Discriminator, outputs logits (sigmoid is fused into the loss)
+    return nn.Sequential(
+        nn.Linear(image_size, hidden_size),
+        nn.LeakyReLU(0.2),
+        nn.Linear(hidden_size, hidden_size),
+        nn.LeakyReLU(0.2),
+        nn.Linear(hidden_size, 1)
+    )
+
+
+def build_generator():
+    return nn.Sequential(
+        nn.Linear(latent_size, hidden_size),
+        nn.ReLU(),
+        nn.Linear(hidden_size, hidden_size),
+        nn.ReLU(),
+        nn.Linear(hidden_size, image_size),
+        nn.Tanh()
+    )
 
 
 def denorm(x):
@@ -67,62 +56,132 @@ def denorm(x):
     return out.clamp(0, 1)
 
 
-# train
-total_step = len(data_loader)
-for epoch in range(num_epochs):
-    images = None
-    fake_images = None
-    for i, (images, _) in enumerate(data_loader):
-        images = images.reshape(batch_size, -1).to(device)
-
-        # labels
-        real_labels = torch.ones(batch_size, 1).to(device)
-        fake_labels = torch.zeros(batch_size, 1).to(device)
-
-        # train discriminator
-        outputs = D(images)
-        d_loss_real = loss_fn(outputs, real_labels)
-        real_score = outputs
-
-        # compute loss with fake image
-        z = torch.randn(batch_size, latent_size).to(device)
-        fake_images = G(z)
-        outputs = D(fake_images)
-        d_loss_fake = loss_fn(outputs, fake_labels)
-        fake_score = outputs
-
-        d_loss = d_loss_real + d_loss_fake
-        d_optimizer.zero_grad()
-        d_loss.backward()
-        d_optimizer.step()
-
-        # train generator
-        # Compute loss with fake images
-        z = torch.randn(batch_size, latent_size).to(device)
-        fake_images = G(z)
-        outputs = D(fake_images)
-        g_loss = loss_fn(outputs, real_labels)
-        # back prop and optimizer
-        d_optimizer.zero_grad()
-        g_optimizer.zero_grad()
-        g_loss.backward()
-        g_optimizer.step()
-
-        if (i + 1) % 200 == 0:
-            print('Epoch [{}/{}], Step [{}/{}], d_loss: {:.4f}, g_loss: {:.4f}, D(x): {:.4f}, D(G(z)): {:.4f}'.format(
-                epoch, num_epochs, i + 1, total_step, d_loss.item(), g_loss.item(), real_score.mean().item(),
-                fake_score.mean().item()
-            ))
-
-    # Save real image
-    if (epoch + 1) == 1:
-        images = images.reshape(images.size(0), 1, 28, 28)
-        save_image(denorm(images), os.path.join(sample_dir, 'real_images.png'))
-
-    # Save sampled images
-    fake_images = fake_images.reshape(fake_images.size(0), 1, 28, 28)
-    save_image(denorm(fake_images), os.path.join(sample_dir, 'fake_images_{}.png'.format(epoch + 1)))
-
-# Save the model checkpoints
-torch.save(G.state_dict(), 'G.pt')
-torch.save(D.state_dict(), 'D.pt')
+def set_requires_grad(model, flag):
+    for p in model.parameters():
+        p.requires_grad_(flag)
+
+
+def main(rank, world_size):
+    """One training process per GPU (or a single CPU process), D and G wrapped separately in DDP."""
+    use_cuda = torch.cuda.is_available()
+    # TCP rendezvous for the process group, override with MASTER_ADDR / MASTER_PORT if the port is taken
+    os.environ.setdefault('MASTER_ADDR', 'localhost')
+    os.environ.setdefault('MASTER_PORT', '12355')
+    dist.init_process_group('nccl' if use_cuda else 'gloo', rank=rank, world_size=world_size)
+    if use_cuda:
+        torch.cuda.set_device(rank)
+        device = torch.device('cuda', rank)
+    else:
+        device = torch.device('cpu')
+    device_ids = [rank] if use_cuda else None
+    is_primary = rank == 0
+    if is_primary:
+        print('device:', device, 'world_size:', world_size)
+
+    # Create a directory if not exists
+    if is_primary and not os.path.exists(sample_dir):
+        os.makedirs(sample_dir)
+
+    # let rank 0 download MNIST before the other ranks read it
+    if not is_primary:
+        dist.barrier()
+    data_loader, _ = mnist.load_data_mnist_without_cfg(batch_size=batch_size, use_normalize=False,
+                                                       pin_memory=use_cuda, distributed=True)
+    if is_primary:
+        dist.barrier()
+
+    D = DDP(build_discriminator().to(device), device_ids=device_ids)
+    G = DDP(build_generator().to(device), device_ids=device_ids)
+
+    # labels, allocated once and sliced for the last partial batch
+    real_labels = torch.ones(batch_size, 1, device=device)
+    fake_labels = torch.zeros(batch_size, 1, device=device)
+
+    # Binary cross entropy loss with logits and optimizer
+    loss_fn = nn.BCEWithLogitsLoss()
+    d_optimizer = torch.optim.Adam(D.parameters(), lr=lr)
+    g_optimizer = torch.optim.Adam(G.parameters(), lr=lr)
+
+    # PNG encoding of sample images runs in the background, off the training loop
+    executor = ThreadPoolExecutor(max_workers=2) if is_primary else None
+    save_futures = []
+
+    # train
+    total_step = len(data_loader)
+    for epoch in range(num_epochs):
+        data_loader.sampler.set_epoch(epoch)
+        images = None
+        fake_images = None
+        for i, (images, _) in enumerate(data_loader):
+            bs = images.size(0)
+            images = images.reshape(bs, -1).to(device, non_blocking=True)
+            rl = real_labels[:bs]
+            fl = fake_labels[:bs]
+
+            # train discriminator on real and fake images in one forward,
+            # fake images built without grad so D's backward does not traverse G
+            z = torch.randn(bs, latent_size, device=device)
+            with torch.no_grad():
+                fake_images = G(z)
+            outputs = D(torch.cat([images, fake_images], dim=0))
+            real_score, fake_score = outputs[:bs], outputs[bs:]
+            d_loss_real = loss_fn(real_score, rl)
+            d_loss_fake = loss_fn(fake_score, fl)
+
+            d_loss = d_loss_real + d_loss_fake
+            d_optimizer.zero_grad(set_to_none=True)
+            d_loss.backward()
+            d_optimizer.step()
+
+            # train generator
+            # Compute loss with fake images, D is frozen so its grads are neither computed nor all-reduced
+            set_requires_grad(D, False)
+            z = torch.randn(bs, latent_size, device=device)
+            fake_images = G(z)
+            with D.no_sync():
+                outputs = D(fake_images)
+            g_loss = loss_fn(outputs, rl)
+            # back prop and optimizer
+            g_optimizer.zero_grad(set_to_none=True)
+            g_loss.backward()
+            g_optimizer.step()
+            set_requires_grad(D, True)
+
+            if is_primary and (i + 1) % 200 == 0:
+                print('Epoch [{}/{}], Step [{}/{}], d_loss: {:.4f}, g_loss: {:.4f}, D(x): {:.4f}, D(G(z)): {:.4f}'.format(
+                    epoch, num_epochs, i + 1, total_step, d_loss.item(), g_loss.item(),
+                    torch.sigmoid(real_score).mean().item(), torch.sigmoid(fake_score).mean().item()
+                ))
+
+        if not is_primary:
+            continue
+
+        # re-raise any error from the previous epoch's saves
+        for future in save_futures:
+            future.result()
+        save_futures = []
+
+        # Save real image
+        if (epoch + 1) == 1:
+            images = images.reshape(images.size(0), 1, 28, 28)
+            save_futures.append(executor.submit(save_image, denorm(images).cpu(),
+                                                os.path.join(sample_dir, 'real_images.png')))
+
+        # Save sampled images
+        fake_images = fake_images.detach().reshape(fake_images.size(0), 1, 28, 28)
+        save_futures.append(executor.submit(save_image, denorm(fake_images).cpu(),
+                                            os.path.join(sample_dir, 'fake_images_{}.png'.format(epoch + 1))))
+
+    # Save the model checkpoints
+    if is_primary:
+        for future in save_futures:
+            future.result()
+        executor.shutdown(wait=True)
+        torch.save(G.module.state_dict(), 'G.pt')
+        torch.save(D.module.state_dict(), 'D.pt')
+    dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    world_size = max(torch.cuda.device_count(), 1)
+    mp.spawn(main, args=(world_size,), nprocs=world_size)
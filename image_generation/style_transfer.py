@@ -10,13 +10,16 @@
 import argparse
 import time
 
-import numpy as np
 import torch
 import torch.nn.functional as F
 import torchvision
 from PIL import Image
+from torch.utils.checkpoint import checkpoint
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+# 图像尺寸在训练中固定不变，让cuDNN为卷积挑选最快的算法；float32矩阵乘允许使用TF32
+torch.backends.cudnn.benchmark = True
+torch.set_float32_matmul_precision('high')
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--content_img_file', type=str, default='../samples/style_transfer_png/mount.png')
@@ -30,6 +33,8 @@ parser.add_argument('--style_weight', type=float, default=1000, help="weight of
 parser.add_argument('--tv_weight', type=float, default=10, help="weight of total variation de-noising loss")
 parser.add_argument('--lr', type=float, default=0.01)
 parser.add_argument('--output_img_file', type=str, default='style_demo.png')
+parser.add_argument('--use_checkpoint', action='store_true',
+                    help="recompute VGG activations in backward to train larger images with less memory")
 args = parser.parse_args()
 print(args)
 
@@ -39,53 +44,76 @@ style_img = Image.open(args.style_img_file)
 content_weight, style_weight, tv_weight = args.content_weight, args.style_weight, args.tv_weight
 
 # 预处理和后处理图像
-rgb_mean = np.array([0.485, 0.456, 0.406])
-rgb_std = np.array([0.229, 0.224, 0.225])
+rgb_mean = torch.tensor([0.485, 0.456, 0.406], device=device).view(1, 3, 1, 1)
+rgb_std = torch.tensor([0.229, 0.224, 0.225], device=device).view(1, 3, 1, 1)
 
 style_layers, content_layers = [0, 5, 10, 19, 28], [25]
 
 
+# 需要中间层的输出，因此把VGG在内容层和样式层处切成若干段，逐段计算并保留每段的输出。
+class FeatureExtractor(torch.nn.Module):
+    def __init__(self, stages, content_ids, style_ids, use_checkpoint=False):
+        super(FeatureExtractor, self).__init__()
+        self.stages = torch.nn.ModuleList(stages)
+        self.content_ids = content_ids
+        self.style_ids = style_ids
+        self.use_checkpoint = use_checkpoint
+
+    def forward(self, X):
+        taps = []
+        for i, stage in enumerate(self.stages):
+            if self.use_checkpoint and i > 0 and torch.is_grad_enabled():
+                # 除第一段外，各段的激活在反向传播时重新计算，用计算换显存。
+                # 各段开头是VGG的原地ReLU，会改写上一段的输出（即checkpoint保存的输入），
+                # 所以先在checkpoint外执行这一层，再对其余层做checkpoint。
+                X = stage[0](X)
+                X = checkpoint(stage[1:], X, use_reentrant=False)
+            else:
+                X = stage(X)
+            taps.append(X)
+        contents = [taps[i] for i in self.content_ids]
+        styles = [taps[i] for i in self.style_ids]
+        return contents, styles
+
+
 def get_net():
     pretrained_net = torchvision.models.vgg19(pretrained=True)
     # 在抽取特征时，我们只需要用到VGG从输入层到最靠近输出层的内容层或样式层之间的所有层。
-    net_list = []
-    for i in range(max(content_layers + style_layers) + 1):
-        net_list.append(pretrained_net.features[i])
-    net = torch.nn.Sequential(*net_list)
-    return net.to(device)
+    taps = sorted(set(content_layers + style_layers))
+    stages = []
+    start = 0
+    for tap in taps:
+        stages.append(pretrained_net.features[start:tap + 1])
+        start = tap + 1
+    content_ids = [taps.index(i) for i in content_layers]
+    style_ids = [taps.index(i) for i in style_layers]
+    net = FeatureExtractor(stages, content_ids, style_ids, args.use_checkpoint).to(device)
+    net.eval()
+    # VGG的参数是固定的，不需要梯度
+    net.requires_grad_(False)
+    return net
 
 
 net = get_net()
 
 
+def autocast():
+    """在GPU上用bfloat16混合精度计算VGG前向和损失，卷积可以走tensor core"""
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=device.type == 'cuda')
+
+
 def preprocess(PIL_img, image_shape):
     process = torchvision.transforms.Compose([
         torchvision.transforms.Resize(image_shape),
-        torchvision.transforms.ToTensor(),
-        torchvision.transforms.Normalize(mean=rgb_mean, std=rgb_std)])
+        torchvision.transforms.ToTensor()])
 
-    return process(PIL_img).unsqueeze(dim=0)  # (batch_size, 3, H, W)
+    X = process(PIL_img).unsqueeze(dim=0).to(device)  # (batch_size, 3, H, W)
+    return (X - rgb_mean) / rgb_std
 
 
 def postprocess(img_tensor):
-    inv_normalize = torchvision.transforms.Normalize(
-        mean=-rgb_mean / rgb_std,
-        std=1 / rgb_std)
     to_PIL_image = torchvision.transforms.ToPILImage()
-    return to_PIL_image(inv_normalize(img_tensor[0].cpu()).clamp(0, 1))
-
-
-# 需要中间层的输出，因此这里我们逐层计算，并保留内容层和样式层的输出。
-def extract_features(X, content_layers, style_layers):
-    contents = []
-    styles = []
-    for i in range(len(net)):
-        X = net[i](X)
-        if i in style_layers:
-            styles.append(X)
-        if i in content_layers:
-            contents.append(X)
-    return contents, styles
+    return to_PIL_image((img_tensor * rgb_std + rgb_mean).clamp_(0, 1)[0].cpu())
 
 
 def get_contents(image_shape):
@@ -94,8 +122,9 @@ def get_contents(image_shape):
     :param image_shape:
     :return:
     """
-    content_X = preprocess(content_img, image_shape).to(device)
-    contents_Y, _ = extract_features(content_X, content_layers, style_layers)
+    content_X = preprocess(content_img, image_shape)
+    with torch.no_grad(), autocast():
+        contents_Y, _ = net(content_X)
     return content_X, contents_Y
 
 
@@ -105,8 +134,9 @@ def get_styles(image_shape):
     :param image_shape:
     :return:
     """
-    style_X = preprocess(style_img, image_shape).to(device)
-    _, styles_Y = extract_features(style_X, content_layers, style_layers)
+    style_X = preprocess(style_img, image_shape)
+    with torch.no_grad(), autocast():
+        _, styles_Y = net(style_X)
     return style_X, styles_Y
 
 
@@ -118,8 +148,8 @@ def content_loss(Y_hat, Y):
 def gram(X):
     """用这样的格拉姆矩阵表达样式层输出的样式"""
     num_channels, n = X.shape[1], X.shape[2] * X.shape[3]
-    X = X.view(num_channels, n)
-    return torch.matmul(X, X.t()) / (num_channels * n)
+    X = X.reshape(num_channels, n)
+    return torch.mm(X, X.t()).div_(num_channels * n)
 
 
 def style_loss(Y_hat, gram_Y):
@@ -135,39 +165,47 @@ def tv_loss(Y_hat):
     :param Y_hat:
     :return:
     """
-    return 0.5 * (F.l1_loss(Y_hat[:, :, 1:, :], Y_hat[:, :, :-1, :]) +
-                  F.l1_loss(Y_hat[:, :, :, 1:], Y_hat[:, :, :, :-1]))
+    dy = (Y_hat[:, :, 1:, :] - Y_hat[:, :, :-1, :]).abs().mean()
+    dx = (Y_hat[:, :, :, 1:] - Y_hat[:, :, :, :-1]).abs().mean()
+    return 0.5 * (dy + dx)
 
 
 def compute_loss(X, contents_Y_hat, styles_Y_hat, contents_Y, styles_Y_gram):
     # 分别计算内容损失、样式损失和总变差损失
-    contents_l = [content_loss(Y_hat, Y) * content_weight for Y_hat, Y in zip(
-        contents_Y_hat, contents_Y)]
-    styles_l = [style_loss(Y_hat, Y) * style_weight for Y_hat, Y in zip(
-        styles_Y_hat, styles_Y_gram)]
+    # 各层的损失先堆叠成一个张量再一次求和，最后统一乘以权重
+    contents_l = torch.stack([content_loss(Y_hat, Y) for Y_hat, Y in zip(
+        contents_Y_hat, contents_Y)]).sum() * content_weight
+    styles_l = torch.stack([style_loss(Y_hat, Y) for Y_hat, Y in zip(
+        styles_Y_hat, styles_Y_gram)]).sum() * style_weight
     tv_l = tv_loss(X) * tv_weight
     # 对所有损失求和
-    l = sum(styles_l) + sum(contents_l) + tv_l
+    l = styles_l + contents_l + tv_l
     return contents_l, styles_l, tv_l, l
 
 
+# 样式图像在各个样式层的格拉姆矩阵styles_Y_gram将在训练前预先计算好。
 # 在样式迁移中，合成图像是唯一需要更新的变量。
-class GeneratedImage(torch.nn.Module):
-    def __init__(self, img_shape):
-        super(GeneratedImage, self).__init__()
-        self.weight = torch.nn.Parameter(torch.rand(*img_shape))
+def get_inits(X, lr, styles_Y):
+    X = X.detach().clone().requires_grad_(True)
+    optimizer = torch.optim.Adam([X], lr=lr)
+    with torch.no_grad(), autocast():
+        styles_Y_gram = [gram(Y) for Y in styles_Y]
+    return X, styles_Y_gram, optimizer
 
-    def forward(self):
-        return self.weight
 
+def train_step(X, contents_Y, styles_Y_gram):
+    """抽取合成图像的特征并计算损失"""
+    with autocast():
+        contents_Y_hat, styles_Y_hat = net(X)
+        return compute_loss(X, contents_Y_hat, styles_Y_hat, contents_Y, styles_Y_gram)
 
-# 样式图像在各个样式层的格拉姆矩阵styles_Y_gram将在训练前预先计算好。
-def get_inits(X, lr, styles_Y):
-    gen_img = GeneratedImage(X.shape).to(device)
-    gen_img.weight.data = X.data
-    optimizer = torch.optim.Adam(gen_img.parameters(), lr=lr)
-    styles_Y_gram = [gram(Y) for Y in styles_Y]
-    return gen_img(), styles_Y_gram, optimizer
+
+# 在GPU上用torch.compile把VGG前向和各项损失融合成少量kernel，并用CUDA graph减少kernel启动开销。
+# main()先后在两个尺寸上训练，dynamic=False让每个尺寸各做一次静态编译；CPU上直接执行。
+if device.type == 'cuda':
+    compiled_train_step = torch.compile(train_step, mode='reduce-overhead', dynamic=False)
+else:
+    compiled_train_step = train_step
 
 
 # 训练
@@ -176,21 +214,24 @@ def train(X, contents_Y, styles_Y, lr, max_epochs, lr_decay_epoch):
     X, styles_Y_gram, optimizer = get_inits(X, lr, styles_Y)
     scheduler = torch.optim.lr_scheduler.StepLR(optimizer, lr_decay_epoch, gamma=0.1)
     for i in range(max_epochs):
+        log_epoch = i % args.log_epochs == 0 and i != 0
+        if log_epoch and device.type == 'cuda':
+            # 等之前排队的GPU计算完成，计时只包含本轮
+            torch.cuda.synchronize()
         start = time.time()
 
-        contents_Y_hat, styles_Y_hat = extract_features(
-            X, content_layers, style_layers)
-        contents_l, styles_l, tv_l, l = compute_loss(
-            X, contents_Y_hat, styles_Y_hat, contents_Y, styles_Y_gram)
+        contents_l, styles_l, tv_l, l = compiled_train_step(X, contents_Y, styles_Y_gram)
 
-        optimizer.zero_grad()
-        l.backward(retain_graph=True)
+        optimizer.zero_grad(set_to_none=True)
+        l.backward()
         optimizer.step()
         scheduler.step()
 
-        if i % args.log_epochs == 0 and i != 0:
+        if log_epoch:
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
             print('epoch %3d/%3d, content loss %.2f, style loss %.2f, total loss %.2f, TV loss %.2f, %.2f sec/epoch'
-                  % (i, max_epochs, sum(contents_l).item(), sum(styles_l).item(), tv_l.item(), l.item(),
+                  % (i, max_epochs, contents_l.item(), styles_l.item(), tv_l.item(), l.item(),
                      time.time() - start))
     return X.detach()
 
@@ -207,7 +248,7 @@ def main():
     image_shape = (300, 450)
     _, content_Y = get_contents(image_shape)
     _, style_Y = get_styles(image_shape)
-    X = preprocess(postprocess(output), image_shape).to(device)
+    X = preprocess(postprocess(output), image_shape)
     big_output = train(X, content_Y, style_Y, args.lr, args.max_epochs, args.lr_decay_epoch)
     out_img = postprocess(big_output)
     out_img.save(args.output_img_file)